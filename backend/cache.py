@@ -1,42 +1,131 @@
-import json
+import asyncio
+import mmap
 import os
-from typing import Dict, List, Any, Optional
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
 import time
 
+import aiofiles
+import orjson
+import xxhash
+
 class LocalCache:
     """Simple local cache implementation for storing chat responses"""
     
-    def __init__(self, cache_dir: str = ".cache", max_age: int = 3600):
+    def __init__(self, cache_dir: str = ".cache", max_age: int = 3600, mem_max: int = 512,
+                 mem_max_bytes: int = 64 * 1024 * 1024):
         """
         Initialize the cache
         
         Args:
             cache_dir: Directory to store cache files
             max_age: Maximum age of cache entries in seconds (default: 1 hour)
+            mem_max: Maximum number of entries kept in the in-memory tier
+            mem_max_bytes: Maximum serialized size of all entries in the in-memory tier
         """
         self.cache_dir = cache_dir
         self.max_age = max_age
         
+        # In-memory LRU tier in front of the disk cache: key -> (timestamp, response, size),
+        # bounded both by entry count and by serialized size so a few very long
+        # responses can't grow it without limit
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()
+        self._mem_max = mem_max
+        self._mem_max_bytes = mem_max_bytes
+        self._mem_bytes = 0
+        self._mem_lock = threading.Lock()
+        
+        # Shard subdirectories already known to exist
+        self._shards = set()
+        
+        # Background writer state, set up by start_writer()
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        
         # Create cache directory if it doesn't exist
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
     
     def _get_cache_key(self, model: str, messages: List[Dict[str, str]]) -> str:
         """Generate a cache key from model and messages"""
-        # Convert messages to a string representation
-        message_str = json.dumps(messages, sort_keys=True)
+        # Hash a length-prefixed byte framing of the messages instead of a
+        # JSON dump, so no intermediate string is built on the hot path
+        h = xxhash.xxh3_64()
+        h.update(model.encode())
+        h.update(b"\x00")
         
-        # Create a hash of the model and messages
-        import hashlib
-        key = hashlib.md5(f"{model}:{message_str}".encode()).hexdigest()
+        for msg in messages:
+            role = msg["role"].encode()
+            content = msg["content"].encode()
+            h.update(struct.pack("<II", len(role), len(content)))
+            h.update(role)
+            h.update(content)
         
-        return key
+        return h.hexdigest()
     
     def _get_cache_path(self, key: str) -> str:
-        """Get the file path for a cache key"""
-        return os.path.join(self.cache_dir, f"{key}.json")
+        """Get the file path for a cache key, sharded by the first two hex chars"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+    
+    def _ensure_shard(self, key: str) -> None:
+        """Create the shard directory for a cache key if needed"""
+        shard = key[:2]
+        if shard not in self._shards:
+            os.makedirs(os.path.join(self.cache_dir, shard), exist_ok=True)
+            self._shards.add(shard)
+    
+    def _mem_get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a key in the in-memory tier, dropping it if expired"""
+        with self._mem_lock:
+            entry = self._mem.get(key)
+            if entry is None:
+                return None
+            
+            timestamp, response, size = entry
+            if time.time() - timestamp > self.max_age:
+                del self._mem[key]
+                self._mem_bytes -= size
+                return None
+            
+            self._mem.move_to_end(key)
+            return response
     
-    def get(self, model: str, messages: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+    def _mem_put(self, key: str, timestamp: float, response: Dict[str, Any], size: int) -> None:
+        """Store a key in the in-memory tier, evicting least recently used entries"""
+        with self._mem_lock:
+            # Drop any older entry first, so an oversized update can't leave a
+            # stale response in memory while disk holds the new one
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_bytes -= old[2]
+            
+            if size > self._mem_max_bytes:
+                return
+            
+            self._mem[key] = (timestamp, response, size)
+            self._mem_bytes += size
+            while len(self._mem) > self._mem_max or self._mem_bytes > self._mem_max_bytes:
+                _, (_, _, evicted_size) = self._mem.popitem(last=False)
+                self._mem_bytes -= evicted_size
+    
+    def _read_entry(self, cache_path: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        """Read and parse a cache file through a read-only memory map, returning it with its size"""
+        with open(cache_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None, 0
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    return orjson.loads(view), size
+                finally:
+                    view.release()
+    
+    async def get(self, model: str, messages: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
         """
         Get a cached response if available and not expired
         
@@ -48,14 +137,18 @@ class LocalCache:
             Cached response or None if not found or expired
         """
         key = self._get_cache_key(model, messages)
-        cache_path = self._get_cache_path(key)
         
-        if not os.path.exists(cache_path):
-            return None
+        response = self._mem_get(key)
+        if response is not None:
+            return response
+        
+        cache_path = self._get_cache_path(key)
         
         try:
-            with open(cache_path, 'r') as f:
-                cache_data = json.load(f)
+            # Parse straight from the page cache off the event loop
+            cache_data, size = await asyncio.to_thread(self._read_entry, cache_path)
+            if cache_data is None:
+                return None
             
             # Check if cache is expired
             if time.time() - cache_data.get("timestamp", 0) > self.max_age:
@@ -63,12 +156,18 @@ class LocalCache:
                 os.remove(cache_path)
                 return None
             
-            return cache_data.get("response")
+            response = cache_data.get("response")
+            if response is not None:
+                self._mem_put(key, cache_data["timestamp"], response, size)
+            return response
+        except FileNotFoundError:
+            # Not cached, or removed by clear_expired since the lookup
+            return None
         except Exception:
             # If there's any error reading the cache, return None
             return None
     
-    def set(self, model: str, messages: List[Dict[str, str]], response: Dict[str, Any]) -> None:
+    async def set(self, model: str, messages: List[Dict[str, str]], response: Dict[str, Any]) -> None:
         """
         Store a response in the cache
         
@@ -79,6 +178,7 @@ class LocalCache:
         """
         key = self._get_cache_key(model, messages)
         cache_path = self._get_cache_path(key)
+        self._ensure_shard(key)
         
         cache_data = {
             "timestamp": time.time(),
@@ -86,36 +186,105 @@ class LocalCache:
         }
         
         try:
-            with open(cache_path, 'w') as f:
-                json.dump(cache_data, f)
+            data = orjson.dumps(cache_data)
+        except Exception:
+            # If the response can't be serialized, just continue without caching
+            return
+        
+        self._mem_put(key, cache_data["timestamp"], response, len(data))
+        
+        if self._write_queue is not None:
+            # Hand the write to the background task so the caller doesn't wait on disk
+            self._write_queue.put_nowait((cache_path, data, cache_data["timestamp"]))
+        else:
+            await self._write_entry(cache_path, data, cache_data["timestamp"])
+    
+    async def _write_entry(self, cache_path: str, data: bytes, timestamp: float) -> None:
+        """Write a serialized entry to disk and publish it atomically"""
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                await f.write(data)
+            
+            # Stamp the file with the cache timestamp so expiry can use stat alone
+            os.utime(tmp_path, (timestamp, timestamp))
+            os.replace(tmp_path, cache_path)
         except Exception:
             # If there's any error writing to the cache, just continue without caching
             pass
     
+    async def _drain_writes(self) -> None:
+        """Write queued cache entries one at a time"""
+        while True:
+            cache_path, data, timestamp = await self._write_queue.get()
+            try:
+                await self._write_entry(cache_path, data, timestamp)
+            finally:
+                self._write_queue.task_done()
+    
+    def start_writer(self) -> None:
+        """Start the background writer; must be called from a running event loop"""
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._drain_writes())
+    
+    async def stop_writer(self) -> None:
+        """Flush pending writes and stop the background writer"""
+        if self._writer_task is None:
+            return
+        
+        await self._write_queue.join()
+        self._writer_task.cancel()
+        self._write_queue = None
+        self._writer_task = None
+    
     def clear(self) -> None:
         """Clear all cache entries"""
-        for filename in os.listdir(self.cache_dir):
-            if filename.endswith(".json"):
-                os.remove(os.path.join(self.cache_dir, filename))
+        with self._mem_lock:
+            self._mem.clear()
+            self._mem_bytes = 0
+        
+        # Removing whole shard trees is cheaper than unlinking file by file
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.endswith(".json"):
+                os.remove(entry.path)
+        self._shards.clear()
     
     def clear_expired(self) -> None:
         """Clear only expired cache entries"""
-        current_time = time.time()
+        # Anything last written before the cutoff is expired
+        cutoff = time.time() - self.max_age
+        
+        with self._mem_lock:
+            expired = [k for k, (ts, _, _) in self._mem.items() if ts < cutoff]
+            for k in expired:
+                self._mem_bytes -= self._mem.pop(k)[2]
         
-        for filename in os.listdir(self.cache_dir):
-            if filename.endswith(".json"):
-                file_path = os.path.join(self.cache_dir, filename)
+        # The file mtime mirrors the cache timestamp, so there is no need to
+        # open and parse each entry just to check its age
+        expired_paths = []
+        with os.scandir(self.cache_dir) as shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
                 
-                try:
-                    with open(file_path, 'r') as f:
-                        cache_data = json.load(f)
-                    
-                    # Check if cache is expired
-                    if current_time - cache_data.get("timestamp", 0) > self.max_age:
-                        os.remove(file_path)
-                except Exception:
-                    # If there's any error reading the cache, remove it
-                    os.remove(file_path)
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith(".json"):
+                            continue
+                        
+                        try:
+                            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                                expired_paths.append(entry.path)
+                        except FileNotFoundError:
+                            continue
+        
+        for file_path in expired_paths:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
 
 # Create a singleton instance
 cache = LocalCache() 
\ No newline at end of file
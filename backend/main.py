@@ -1,37 +1,99 @@
 import os
-import json
+import re
+import aiofiles
 import httpx
+import orjson
 import asyncio
 import base64
+import time
 import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import List, Dict, Optional, Any
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, File, UploadFile
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException, Depends, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse
-from sqlalchemy import create_engine, Column, Integer, String, Text
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import create_engine, event, func, select, text, Column, Index, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import aliased, sessionmaker, Session
 
 # Import the cache
 from cache import cache
 
 # Database setup
 DATABASE_URL = "sqlite:///./chat_history.db"
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, _):
+    """Use WAL so history reads don't block writes, and cut fsyncs per commit"""
+    cursor = dbapi_conn.cursor()
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY",
+                   "mmap_size=268435456", "cache_size=-65536"):
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 class ChatHistory(Base):
     __tablename__ = "chat_history"
-    id = Column(Integer, primary_key=True, index=True)
-    conversation_id = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(String)
     role = Column(String)
     content = Column(Text)
-    timestamp = Column(String)
+    timestamp = Column(Integer, index=True)  # epoch nanoseconds
+
+    __table_args__ = (
+        # Lets the first-user-message lookup in list_conversations be index-only
+        Index("ix_chat_history_conv_role_id", "conversation_id", "role", "id"),
+        # Serves a conversation's rows in insertion order without a sort
+        Index("ix_chat_history_conv_id", "conversation_id", "id"),
+    )
+
+def migrate_text_timestamps():
+    """Rebuild chat_history from older databases that stored timestamps as TEXT"""
+    with engine.begin() as conn:
+        columns = {row[1]: row[2] for row in conn.execute(text("PRAGMA table_info(chat_history)"))}
+        if columns.get("timestamp", "INTEGER").upper() == "INTEGER":
+            return
+        
+        conn.execute(text("ALTER TABLE chat_history RENAME TO chat_history_old"))
+        # Renamed indexes keep their names, which the new table needs
+        index_names = conn.execute(text(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = 'chat_history_old' AND sql IS NOT NULL"
+        )).scalars().all()
+        for name in index_names:
+            conn.execute(text(f'DROP INDEX "{name}"'))
+        
+        ChatHistory.__table__.create(conn)
+        # The old values came from the event loop's monotonic clock, not the epoch,
+        # so they can't be converted; the real times are lost. Stamp legacy rows
+        # with the migration time instead, 1ns apart in id order to keep their order
+        conn.execute(
+            text(
+                "INSERT INTO chat_history (id, conversation_id, role, content, timestamp) "
+                "SELECT id, conversation_id, role, content, "
+                ":now - (SELECT MAX(id) FROM chat_history_old) + id "
+                "FROM chat_history_old"
+            ),
+            {"now": time.time_ns()}
+        )
+        conn.execute(text("DROP TABLE chat_history_old"))
 
+migrate_text_timestamps()
 Base.metadata.create_all(bind=engine)
 
+# create_all skips existing tables, so bring indexes on older databases in line:
+# the composite indexes cover conversation_id lookups, and id is the rowid
+for index in ChatHistory.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+with engine.begin() as conn:
+    conn.execute(text("DROP INDEX IF EXISTS ix_chat_history_conversation_id"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_chat_history_id"))
+
 def get_db():
     db = SessionLocal()
     try:
@@ -39,8 +101,56 @@ def get_db():
     finally:
         db.close()
 
+def ends_with_reply(db: Session, conversation_id: str, content: str) -> bool:
+    """Check whether a conversation's latest row is this assistant reply"""
+    last_row = db.execute(
+        text("SELECT role, content FROM chat_history WHERE conversation_id = :c ORDER BY id DESC LIMIT 1"),
+        {"c": conversation_id}
+    ).first()
+    return last_row is not None and last_row.role == "assistant" and last_row.content == content
+
+def persist_turn(db: Session, conversation_id: str, user_content: Optional[str], assistant_content: Optional[str]) -> None:
+    """Save a chat turn's user and assistant messages in a single commit (blocking)"""
+    timestamp = time.time_ns()
+    rows = []
+    if user_content is not None:
+        rows.append(ChatHistory(
+            conversation_id=conversation_id,
+            role="user",
+            content=user_content,
+            timestamp=timestamp
+        ))
+    
+    if assistant_content is not None:
+        rows.append(ChatHistory(
+            conversation_id=conversation_id,
+            role="assistant",
+            content=assistant_content,
+            timestamp=timestamp
+        ))
+    
+    if rows:
+        db.add_all(rows)
+        db.commit()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared resources on startup and release them on shutdown"""
+    # One pooled client for all Ollama calls
+    app.state.http = httpx.AsyncClient(
+        base_url=OLLAMA_API_URL,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    cache.start_writer()
+    
+    yield
+    
+    await cache.stop_writer()
+    await app.state.http.aclose()
+
 # FastAPI app setup
-app = FastAPI(title="Offline GPT")
+app = FastAPI(title="Offline GPT", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Enable CORS
 app.add_middleware(
@@ -54,6 +164,12 @@ app.add_middleware(
 # Ollama API URL
 OLLAMA_API_URL = "http://localhost:11434/api"
 
+# Ollama payloads are serialized with orjson and sent as raw bodies
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Pulls the still-escaped message content out of a raw Ollama NDJSON line
+_CONTENT_RE = re.compile(rb'"content"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
 # Pydantic models
 class Message(BaseModel):
     role: str
@@ -86,54 +202,77 @@ class MultimodalChatRequest(BaseModel):
     stream: bool = True
     conversation_id: Optional[str] = None
 
+def to_ollama_message(msg: MultimodalMessage) -> Dict[str, Any]:
+    """Convert a content-part message to Ollama's text content + base64 images shape"""
+    texts = []
+    images = []
+    for part in msg.content:
+        if part.type == "text" and part.text:
+            texts.append(part.text)
+        elif part.type == "image_url" and part.image_url:
+            # Ollama takes bare base64, so strip the data URL prefix
+            _, sep, data = part.image_url.get("url", "").partition("base64,")
+            if sep:
+                images.append(data)
+    
+    message = {"role": msg.role, "content": "\n".join(texts)}
+    if images:
+        message["images"] = images
+    return message
+
+# The installed model list changes rarely, so keep it briefly in memory
+MODELS_CACHE_TTL = 10.0
+_models_cache: Optional[tuple] = None  # (fetched_at, response)
+_models_lock = asyncio.Lock()
+
 # API endpoints
 @app.get("/api/models")
 async def list_models():
     """List all available models from Ollama"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_API_URL}/tags")
+    global _models_cache
+    if _models_cache is not None and time.monotonic() - _models_cache[0] < MODELS_CACHE_TTL:
+        return _models_cache[1]
+    
+    # Only one request refreshes the list; the rest wait and reuse its result
+    async with _models_lock:
+        if _models_cache is not None and time.monotonic() - _models_cache[0] < MODELS_CACHE_TTL:
+            return _models_cache[1]
+        
+        try:
+            client = app.state.http
+            response = await client.get("/tags")
             if response.status_code == 200:
-                models = response.json().get("models", [])
-                return {"models": models}
+                models = orjson.loads(response.content).get("models", [])
+                _models_cache = (time.monotonic(), {"models": models})
+                return _models_cache[1]
             else:
                 raise HTTPException(status_code=response.status_code, detail="Failed to fetch models from Ollama")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error connecting to Ollama: {str(e)}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error connecting to Ollama: {str(e)}")
 
 @app.post("/api/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, db: Session = Depends(get_db)):
     """Non-streaming chat endpoint"""
     try:
-        # Convert messages to the format expected by the cache
-        messages_for_cache = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        # Convert messages to the format expected by the cache, noting the
+        # last user message on the same pass
+        messages_for_cache = []
+        last_user_content = None
+        for msg in request.messages:
+            messages_for_cache.append({"role": msg.role, "content": msg.content})
+            if msg.role == "user":
+                last_user_content = msg.content
         
         # Check cache first
-        cached_response = cache.get(request.model, messages_for_cache)
+        cached_response = await cache.get(request.model, messages_for_cache)
         if cached_response:
             # Save to history if conversation_id is provided
             if request.conversation_id:
-                db = SessionLocal()
-                # Save the last user message
-                last_user_msg = next((msg for msg in reversed(request.messages) if msg.role == "user"), None)
-                if last_user_msg:
-                    db_msg = ChatHistory(
-                        conversation_id=request.conversation_id,
-                        role="user",
-                        content=last_user_msg.content,
-                        timestamp=str(asyncio.get_event_loop().time())
-                    )
-                    db.add(db_msg)
-                
-                # Save the assistant response
-                db_response = ChatHistory(
-                    conversation_id=request.conversation_id,
-                    role="assistant",
-                    content=cached_response["message"]["content"],
-                    timestamp=str(asyncio.get_event_loop().time())
-                )
-                db.add(db_response)
-                db.commit()
+                # A re-submitted prompt has usually been recorded already
+                reply = cached_response["message"]["content"]
+                already_saved = await asyncio.to_thread(ends_with_reply, db, request.conversation_id, reply)
+                if not already_saved:
+                    await asyncio.to_thread(persist_turn, db, request.conversation_id, last_user_content, reply)
             
             return cached_response
         
@@ -143,44 +282,48 @@ async def chat(request: ChatRequest):
             "stream": False
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{OLLAMA_API_URL}/chat", json=payload)
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Save to cache
-                cache.set(request.model, messages_for_cache, result)
-                
-                # Save to history if conversation_id is provided
-                if request.conversation_id:
-                    db = SessionLocal()
-                    # Save the last user message
-                    last_user_msg = next((msg for msg in reversed(request.messages) if msg.role == "user"), None)
-                    if last_user_msg:
-                        db_msg = ChatHistory(
-                            conversation_id=request.conversation_id,
-                            role="user",
-                            content=last_user_msg.content,
-                            timestamp=str(asyncio.get_event_loop().time())
-                        )
-                        db.add(db_msg)
-                    
-                    # Save the assistant response
-                    db_response = ChatHistory(
-                        conversation_id=request.conversation_id,
-                        role="assistant",
-                        content=result["message"]["content"],
-                        timestamp=str(asyncio.get_event_loop().time())
-                    )
-                    db.add(db_response)
-                    db.commit()
-                
-                return result
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Failed to get response from Ollama")
+        client = app.state.http
+        response = await client.post("/chat", content=orjson.dumps(payload), headers=_JSON_HEADERS)
+        if response.status_code == 200:
+            result = orjson.loads(response.content)
+            
+            # Save to cache
+            await cache.set(request.model, messages_for_cache, result)
+            
+            # Save to history if conversation_id is provided
+            if request.conversation_id:
+                await asyncio.to_thread(persist_turn, db, request.conversation_id, last_user_content, result["message"]["content"])
+            
+            return result
+        else:
+            raise HTTPException(status_code=response.status_code, detail="Failed to get response from Ollama")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+async def iter_ndjson_lines(response: httpx.Response):
+    """Yield complete NDJSON lines from an Ollama stream as raw bytes"""
+    buffer = bytearray()
+    # No chunk size: a sized aiter_bytes holds data back until that many bytes
+    # arrive, which would batch up tokens instead of forwarding them as they come
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline == -1:
+                break
+            line = bytes(buffer[:newline]).strip()
+            del buffer[:newline + 1]
+            if line:
+                yield line
+    
+    # Flush a final line that wasn't newline-terminated
+    line = bytes(buffer).strip()
+    if line:
+        yield line
+
+# Prebuilt SSE frame so every chunk the generator yields is bytes
+_SSE_OLLAMA_ERROR = b"data: " + orjson.dumps({"error": "Failed to connect to Ollama"}) + b"\n\n"
+
 async def stream_response(model: str, messages: List[Dict]):
     """Stream response from Ollama"""
     payload = {
@@ -189,26 +332,53 @@ async def stream_response(model: str, messages: List[Dict]):
         "stream": True
     }
     
-    async with httpx.AsyncClient() as client:
-        async with client.stream("POST", f"{OLLAMA_API_URL}/chat", json=payload, timeout=60.0) as response:
-            if response.status_code != 200:
-                yield f"data: {json.dumps({'error': 'Failed to connect to Ollama'})}\n\n"
-                return
-                
-            async for chunk in response.aiter_text():
-                if chunk.strip():
-                    yield f"data: {chunk}\n\n"
+    client = app.state.http
+    async with client.stream("POST", "/chat", content=orjson.dumps(payload), headers=_JSON_HEADERS) as response:
+        if response.status_code != 200:
+            yield _SSE_OLLAMA_ERROR
+            return
+            
+        async for line in iter_ndjson_lines(response):
+            yield b"data: " + line + b"\n\n"
 
 @app.post("/api/chat/stream")
-async def stream_chat(request: ChatRequest):
+async def stream_chat(request: Request):
     """Streaming chat endpoint using SSE"""
-    messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    # The messages are forwarded to Ollama as-is, so skip building Pydantic
+    # models and only check the fields we rely on
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON")
+    
+    if not isinstance(body, dict) or not isinstance(body.get("model"), str) or not isinstance(body.get("messages"), list):
+        raise HTTPException(status_code=422, detail="Request must include a model name and a list of messages")
     
     return StreamingResponse(
-        stream_response(request.model, messages),
+        stream_response(body["model"], body["messages"]),
         media_type="text/event-stream"
     )
 
+_WS_OLLAMA_ERROR = orjson.dumps({"error": "Failed to connect to Ollama"}).decode()
+
+# Websocket flow control: give up on a client that stops reading, and merge
+# tokens that arrive in quick succession into fewer frames
+WS_SEND_TIMEOUT = 5.0
+WS_COALESCE_BYTES = 64
+WS_COALESCE_SECONDS = 0.02
+
+_DONE_RE = re.compile(rb'"done"\s*:\s*true')
+
+async def send_ws_frame(websocket: WebSocket, frame: bytes) -> None:
+    """Send one text frame, raising asyncio.TimeoutError if the client stalls"""
+    await asyncio.wait_for(websocket.send_text(frame.decode(errors="replace")), timeout=WS_SEND_TIMEOUT)
+
+def coalesced_frame(parts: List[bytes], last_line: bytes) -> bytes:
+    """Build one Ollama-shaped chunk from held content pieces (the line itself if only one)"""
+    if len(parts) == 1:
+        return last_line
+    return b'{"message":{"role":"assistant","content":"' + b"".join(parts) + b'"},"done":false}'
+
 @app.websocket("/api/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time chat"""
@@ -216,7 +386,7 @@ async def websocket_endpoint(websocket: WebSocket):
     
     try:
         while True:
-            data = await websocket.receive_json()
+            data = orjson.loads(await websocket.receive_text())
             model = data.get("model", "llama2")
             messages = data.get("messages", [])
             conversation_id = data.get("conversation_id")
@@ -228,171 +398,235 @@ async def websocket_endpoint(websocket: WebSocket):
                 "stream": True
             }
             
-            # Save user message to history if conversation_id is provided
+            # The user message is saved together with the assistant reply once
+            # streaming has finished, so the turn costs a single commit
+            last_user_content = None
             if conversation_id:
-                db = SessionLocal()
-                last_user_msg = next((msg for msg in reversed(messages) if msg["role"] == "user"), None)
-                if last_user_msg:
-                    db_msg = ChatHistory(
-                        conversation_id=conversation_id,
-                        role="user",
-                        content=last_user_msg["content"],
-                        timestamp=str(asyncio.get_event_loop().time())
-                    )
-                    db.add(db_msg)
-                    db.commit()
+                # Scan from the end; the new user turn is almost always last
+                for i in range(len(messages) - 1, -1, -1):
+                    if messages[i]["role"] == "user":
+                        last_user_content = messages[i]["content"]
+                        break
             
             # Stream the response from Ollama
-            full_response = ""
-            async with httpx.AsyncClient() as client:
-                async with client.stream("POST", f"{OLLAMA_API_URL}/chat", json=payload, timeout=60.0) as response:
-                    if response.status_code != 200:
-                        await websocket.send_json({"error": "Failed to connect to Ollama"})
-                        continue
+            # Collect the escaped content pieces and decode them once at the end
+            # rather than parsing every line; only needed when saving history
+            content_parts: List[bytes] = [b'"']
+            client = app.state.http
+            async with client.stream("POST", "/chat", content=orjson.dumps(payload), headers=_JSON_HEADERS) as response:
+                if response.status_code != 200:
+                    await websocket.send_text(_WS_OLLAMA_ERROR)
+                    continue
+                    
+                pending: List[bytes] = []
+                pending_line = b""
+                pending_size = 0
+                last_flush = time.monotonic()
+                lines = iter_ndjson_lines(response)
+                # Read ahead in a task so a slow next token can be waited on with a
+                # deadline without cancelling (and so closing) the line generator
+                next_line = asyncio.ensure_future(anext(lines, None))
+                try:
+                    while True:
+                        if pending:
+                            # Held tokens go out when the coalescing window closes,
+                            # even if Ollama hasn't sent the next line yet
+                            remaining = WS_COALESCE_SECONDS - (time.monotonic() - last_flush)
+                            done, _ = await asyncio.wait({next_line}, timeout=max(remaining, 0))
+                            if not done:
+                                await send_ws_frame(websocket, coalesced_frame(pending, pending_line))
+                                pending.clear()
+                                pending_size = 0
+                                last_flush = time.monotonic()
+                                continue
+                        
+                        line = await next_line
+                        if line is None:
+                            break
+                        next_line = asyncio.ensure_future(anext(lines, None))
                         
-                    async for chunk in response.aiter_text():
-                        if chunk.strip():
-                            try:
-                                chunk_data = json.loads(chunk)
-                                if "message" in chunk_data and "content" in chunk_data["message"]:
-                                    content = chunk_data["message"]["content"]
-                                    full_response += content
-                                    await websocket.send_text(chunk)
-                            except json.JSONDecodeError:
-                                await websocket.send_text(chunk)
+                        match = _CONTENT_RE.search(line)
+                        if match and conversation_id:
+                            content_parts.append(match.group(1))
+                        
+                        if match and not _DONE_RE.search(line):
+                            # Plain token: hold it until enough bytes or time accumulate
+                            pending.append(match.group(1))
+                            pending_line = line
+                            pending_size += len(match.group(1))
+                            if pending_size < WS_COALESCE_BYTES and time.monotonic() - last_flush < WS_COALESCE_SECONDS:
+                                continue
+                            frame = coalesced_frame(pending, pending_line)
+                            pending.clear()
+                            pending_size = 0
+                        else:
+                            # Anything else (the final chunk, errors) goes out as-is,
+                            # after whatever tokens are still held
+                            if pending:
+                                await send_ws_frame(websocket, coalesced_frame(pending, pending_line))
+                                pending.clear()
+                                pending_size = 0
+                            frame = line
+                        
+                        await send_ws_frame(websocket, frame)
+                        last_flush = time.monotonic()
+                finally:
+                    if not next_line.done():
+                        next_line.cancel()
+                        await asyncio.wait({next_line})
+
+                if pending:
+                    await send_ws_frame(websocket, coalesced_frame(pending, pending_line))
             
-            # Save assistant response to history if conversation_id is provided
-            if conversation_id and full_response:
-                db = SessionLocal()
-                db_response = ChatHistory(
-                    conversation_id=conversation_id,
-                    role="assistant",
-                    content=full_response,
-                    timestamp=str(asyncio.get_event_loop().time())
-                )
-                db.add(db_response)
-                db.commit()
+            # Save the turn to history if conversation_id is provided
+            if conversation_id:
+                content_parts.append(b'"')
+                full_response = orjson.loads(b"".join(content_parts))
+                with SessionLocal() as db:
+                    await asyncio.to_thread(persist_turn, db, conversation_id, last_user_content, full_response or None)
                 
     except WebSocketDisconnect:
         pass
+    except asyncio.TimeoutError:
+        # The client stopped reading; drop it rather than buffer without bound
+        await websocket.close(code=1011)
     except Exception as e:
-        await websocket.send_json({"error": str(e)})
+        await websocket.send_text(orjson.dumps({"error": str(e)}).decode())
 
 @app.get("/api/history/{conversation_id}")
 def get_conversation_history(conversation_id: str, db: Session = Depends(get_db)):
     """Get chat history for a specific conversation"""
-    history = db.query(ChatHistory).filter(ChatHistory.conversation_id == conversation_id).all()
-    return {"messages": [{"role": h.role, "content": h.content} for h in history]}
+    rows = db.execute(
+        text("SELECT role, content FROM chat_history WHERE conversation_id = :c ORDER BY id"),
+        {"c": conversation_id}
+    ).mappings().all()
+    return {"messages": [dict(row) for row in rows]}
 
 @app.get("/api/conversations")
 def list_conversations(db: Session = Depends(get_db)):
     """List all conversation IDs with titles"""
-    # Get unique conversation IDs
-    conversation_ids = db.query(ChatHistory.conversation_id).distinct().all()
-    result = []
+    # One grouped pass finds each conversation's first user row and last row,
+    # then both are joined back by primary key
+    summary = (
+        select(
+            ChatHistory.conversation_id,
+            func.min(ChatHistory.id).filter(ChatHistory.role == "user").label("first_user_id"),
+            func.max(ChatHistory.id).label("last_id"),
+        )
+        .group_by(ChatHistory.conversation_id)
+        .subquery()
+    )
+    first_user_row = aliased(ChatHistory)
+    last_row = aliased(ChatHistory)
     
-    for conv_id in conversation_ids:
-        conv_id = conv_id[0]
-        # Get the first user message as the title
-        first_message = db.query(ChatHistory).filter(
-            ChatHistory.conversation_id == conv_id,
-            ChatHistory.role == "user"
-        ).order_by(ChatHistory.id.asc()).first()
-        
+    rows = db.execute(
+        # Fetch at most 31 characters of the title message: enough to tell
+        # whether it needs truncating without shipping long prompts out of SQLite
+        select(summary.c.conversation_id, func.substr(first_user_row.content, 1, 31), last_row.timestamp)
+        .select_from(summary)
+        .outerjoin(first_user_row, first_user_row.id == summary.c.first_user_id)
+        .join(last_row, last_row.id == summary.c.last_id)
+        .order_by(last_row.timestamp.desc())
+    ).all()
+    
+    result = []
+    for conv_id, title_raw, last_ts in rows:
         title = "New conversation"
-        if first_message:
+        if title_raw is not None:
             # Truncate long messages
-            content = first_message.content
-            if len(content) > 30:
-                content = content[:30] + "..."
-            title = content
-            
+            title = title_raw if len(title_raw) <= 30 else title_raw[:30] + "..."
+        
         result.append({
             "id": conv_id,
             "title": title,
-            "timestamp": db.query(ChatHistory.timestamp).filter(
-                ChatHistory.conversation_id == conv_id
-            ).order_by(ChatHistory.id.desc()).first()[0]
+            "timestamp": datetime.fromtimestamp(last_ts / 1e9, tz=timezone.utc).isoformat()
         })
     
-    # Sort by timestamp (newest first)
-    result.sort(key=lambda x: x["timestamp"], reverse=True)
     return {"conversations": result}
 
 @app.post("/api/chat/multimodal")
-async def multimodal_chat(request: MultimodalChatRequest):
+async def multimodal_chat(request: MultimodalChatRequest, db: Session = Depends(get_db)):
     """Non-streaming multimodal chat endpoint"""
     try:
         # Format the request for Ollama
         payload = {
             "model": request.model,
-            "messages": [{"role": msg.role, "content": msg.content} for msg in request.messages],
+            "messages": [to_ollama_message(msg) for msg in request.messages],
             "stream": False
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{OLLAMA_API_URL}/chat", json=payload)
-            if response.status_code == 200:
-                result = response.json()
+        client = app.state.http
+        response = await client.post("/chat", content=orjson.dumps(payload), headers=_JSON_HEADERS)
+        if response.status_code == 200:
+            result = orjson.loads(response.content)
+            
+            # Save to history if conversation_id is provided
+            if request.conversation_id:
+                # Save the last user message - for multimodal, store a reference to the image
+                last_user_content = None
+                last_user_msg = None
+                for i in range(len(request.messages) - 1, -1, -1):
+                    if request.messages[i].role == "user":
+                        last_user_msg = request.messages[i]
+                        break
                 
-                # Save to history if conversation_id is provided
-                if request.conversation_id:
-                    db = SessionLocal()
-                    # Save the last user message - for multimodal, store a reference to the image
-                    last_user_msg = next((msg for msg in reversed(request.messages) if msg.role == "user"), None)
-                    if last_user_msg:
-                        # For multimodal messages, we'll store a simplified version in the DB
-                        content_text = ""
-                        for content_part in last_user_msg.content:
-                            if content_part.type == "text":
-                                content_text += content_part.text + " "
-                            elif content_part.type == "image_url":
-                                content_text += "[IMAGE] "
-                        
-                        db_msg = ChatHistory(
-                            conversation_id=request.conversation_id,
-                            role="user",
-                            content=content_text.strip(),
-                            timestamp=str(asyncio.get_event_loop().time())
-                        )
-                        db.add(db_msg)
-                    
-                    # Save the assistant response
-                    db_response = ChatHistory(
-                        conversation_id=request.conversation_id,
-                        role="assistant",
-                        content=result["message"]["content"],
-                        timestamp=str(asyncio.get_event_loop().time())
-                    )
-                    db.add(db_response)
-                    db.commit()
+                if last_user_msg:
+                    # For multimodal messages, we'll store a simplified version in the DB
+                    content_text = ""
+                    for content_part in last_user_msg.content:
+                        if content_part.type == "text":
+                            content_text += content_part.text + " "
+                        elif content_part.type == "image_url":
+                            content_text += "[IMAGE] "
+                    last_user_content = content_text.strip()
                 
-                return result
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Failed to get response from Ollama")
+                await asyncio.to_thread(persist_turn, db, request.conversation_id, last_user_content, result["message"]["content"])
+            
+            return result
+        else:
+            raise HTTPException(status_code=response.status_code, detail="Failed to get response from Ollama")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+# Upload read size; a multiple of 3 so most chunks base64-encode without carry-over
+UPLOAD_CHUNK_SIZE = 3 << 16
+ALLOWED_IMAGE_EXTENSIONS = {"png", "jpg", "jpeg", "webp", "gif", "bmp"}
+
 @app.post("/api/upload")
 async def upload_image(file: UploadFile = File(...)):
     """Upload an image and return a reference to it"""
+    # Only keep a known image extension from the client-supplied name
+    ext = os.path.splitext(file.filename or "")[1].lower().lstrip(".")
+    if ext not in ALLOWED_IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported image type: .{ext or '?'}")
+    
     try:
-        # Read the file content
-        contents = await file.read()
-        
         # Create a unique filename
-        filename = f"{uuid.uuid4()}.{file.filename.split('.')[-1]}"
+        filename = f"{uuid.uuid4().hex}.{ext}"
         
         # Create uploads directory if it doesn't exist
         os.makedirs("uploads", exist_ok=True)
         
-        # Save the file
+        # Stream the file to disk, base64-encoding it for Ollama into a single
+        # buffer as we go. The raw upload is only held a chunk at a time; the peak
+        # is the base64 buffer plus the str decoded from it (~2.8x the upload)
         file_path = f"uploads/{filename}"
-        with open(file_path, "wb") as f:
-            f.write(contents)
+        b64 = bytearray()
+        pending = b""
+        async with aiofiles.open(file_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+                
+                # base64 pieces only concatenate cleanly on 3-byte boundaries;
+                # a full chunk already is one, so only short reads carry bytes over
+                if pending:
+                    chunk = pending + chunk
+                usable = len(chunk) - len(chunk) % 3
+                b64 += base64.b64encode(chunk[:usable])
+                pending = chunk[usable:]
         
-        # Convert to base64 for Ollama
-        base64_image = base64.b64encode(contents).decode("utf-8")
+        b64 += base64.b64encode(pending)
+        base64_image = b64.decode("ascii")
         
         return {
             "filename": filename,
@@ -1,22 +1,27 @@
 import uvicorn
+import asyncio
+import importlib
 import os
 import subprocess
 import sys
-import time
-import requests
-import json
+import httpx
+import orjson
 
-def check_ollama_running():
+OLLAMA_URL = "http://localhost:11434"
+
+async def check_ollama_running(client: httpx.AsyncClient):
     """Check if Ollama is running and accessible"""
     try:
-        response = requests.get("http://localhost:11434/api/tags")
+        # The root endpoint answers without listing models; a short timeout keeps
+        # a hung server from stalling the poll loop
+        response = await client.head("/", timeout=0.5)
         return response.status_code == 200
     except:
         return False
 
-def start_ollama():
+async def start_ollama(client: httpx.AsyncClient):
     """Start Ollama if it's not running"""
-    if not check_ollama_running():
+    if not await check_ollama_running(client):
         print("Ollama is not running. Attempting to start Ollama...")
         
         # Check the operating system
@@ -45,23 +50,23 @@ def start_ollama():
         
         # Wait for Ollama to start
         print("Waiting for Ollama to start...")
-        for _ in range(10):
-            if check_ollama_running():
+        for _ in range(50):
+            if await check_ollama_running(client):
                 print("Ollama is now running!")
                 return True
-            time.sleep(1)
+            await asyncio.sleep(0.2)
         
         print("Timed out waiting for Ollama to start. Please start it manually.")
         return False
     
     return True
 
-def check_available_models():
+async def check_available_models(client: httpx.AsyncClient):
     """Check which models are available in Ollama"""
     try:
-        response = requests.get("http://localhost:11434/api/tags")
+        response = await client.get("/api/tags")
         if response.status_code == 200:
-            models = response.json().get("models", [])
+            models = orjson.loads(response.content).get("models", [])
             if not models:
                 print("No models found in Ollama.")
                 print("Please pull at least one model using 'ollama pull <model_name>'")
@@ -80,18 +85,33 @@ def check_available_models():
         print(f"Error checking available models: {e}")
         return False
 
+async def main_async():
+    """Wait for Ollama while the app module loads, then check available models"""
+    async with httpx.AsyncClient(base_url=OLLAMA_URL, timeout=5.0) as client:
+        # Importing the app (FastAPI, SQLAlchemy, table setup) doesn't depend on
+        # Ollama, so do it in a thread while the liveness poll runs
+        running, _ = await asyncio.gather(
+            start_ollama(client),
+            asyncio.to_thread(importlib.import_module, "main"),
+        )
+        if not running:
+            return False
+        
+        # Check available models
+        if not await check_available_models(client):
+            print("Continuing anyway, but you may need to pull models first.")
+    
+    return True
+
 def main():
     """Main function to run the FastAPI server"""
     # Check if Ollama is running
-    if not start_ollama():
+    if not asyncio.run(main_async()):
         sys.exit(1)
     
-    # Check available models
-    if not check_available_models():
-        print("Continuing anyway, but you may need to pull models first.")
-    
     print("\nStarting Offline GPT backend server...")
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # No reload here: the file-watcher would start a second process and re-import the app
+    uvicorn.run("main:app", host="0.0.0.0", port=8000)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
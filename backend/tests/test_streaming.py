@@ -0,0 +1,101 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import httpx
+import orjson
+from fastapi.testclient import TestClient
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+LINE_INTERVAL = 0.2
+STALL = 0.6
+LINES = [
+    b'{"message":{"role":"assistant","content":"A"},"done":false}\n',
+    b'{"message":{"role":"assistant","content":"B"},"done":false}\n',
+    b'{"message":{"role":"assistant","content":"C"},"done":false}\n',
+    b'{"message":{"role":"assistant","content":""},"done":true}\n',
+]
+
+def import_main():
+    """Import the app with its database and cache created in a scratch directory"""
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+def slow_ollama(request: httpx.Request) -> httpx.Response:
+    """Mock Ollama that sends one NDJSON line every LINE_INTERVAL seconds"""
+    async def body():
+        for i, line in enumerate(LINES):
+            if i:
+                await asyncio.sleep(LINE_INTERVAL)
+            yield line
+    return httpx.Response(200, content=body())
+
+def stalling_ollama(request: httpx.Request) -> httpx.Response:
+    """Mock Ollama that sends two quick tokens, then stalls before the rest"""
+    async def body():
+        yield b'{"message":{"role":"assistant","content":"A"},"done":false}\n'
+        await asyncio.sleep(0.005)
+        yield b'{"message":{"role":"assistant","content":"B"},"done":false}\n'
+        await asyncio.sleep(STALL)
+        yield b'{"message":{"role":"assistant","content":"C"},"done":false}\n'
+        yield b'{"message":{"role":"assistant","content":""},"done":true}\n'
+    return httpx.Response(200, content=body())
+
+class NdjsonStreamingTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.main = import_main()
+
+    async def test_lines_are_yielded_as_they_arrive(self):
+        """Each line must come out when Ollama sends it, not when a buffer fills"""
+        async with httpx.AsyncClient(transport=httpx.MockTransport(slow_ollama), base_url="http://ollama") as client:
+            start = time.monotonic()
+            arrivals = []
+            async with client.stream("POST", "/chat") as response:
+                async for line in self.main.iter_ndjson_lines(response):
+                    arrivals.append((line, time.monotonic() - start))
+
+        self.assertEqual([line for line, _ in arrivals], [line.strip() for line in LINES])
+        for i, (_, at) in enumerate(arrivals):
+            expected = i * LINE_INTERVAL
+            self.assertGreaterEqual(at, expected - 0.05)
+            self.assertLess(at, expected + LINE_INTERVAL / 2, f"line {i} was held back")
+
+class WebSocketCoalescingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.main = import_main()
+
+    def test_held_tokens_flush_on_deadline(self):
+        """Tokens held for coalescing must not wait for the next token to arrive"""
+        with TestClient(self.main.app) as client:
+            client.app.state.http = httpx.AsyncClient(
+                transport=httpx.MockTransport(stalling_ollama), base_url="http://ollama"
+            )
+            with client.websocket_connect("/api/ws") as ws:
+                start = time.monotonic()
+                ws.send_text(orjson.dumps({"model": "llama2", "messages": [{"role": "user", "content": "hi"}]}).decode())
+                frames = []
+                while True:
+                    frame = orjson.loads(ws.receive_text())
+                    frames.append((frame, time.monotonic() - start))
+                    if frame.get("done"):
+                        break
+
+        contents = [frame["message"]["content"] for frame, _ in frames if not frame["done"]]
+        self.assertEqual("".join(contents), "ABC")
+        self.assertEqual(contents[0], "AB")
+        self.assertLess(frames[0][1], STALL / 2, "held tokens waited for the next token")
+
+if __name__ == "__main__":
+    unittest.main()